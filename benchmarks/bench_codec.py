@@ -0,0 +1,55 @@
+"""
+compare the generic dictionary encoding of Chatmsg (type 0x05) with the
+packed record encoding (types 0x06/0x07) on a RESP_LIST_MESSAGES payload
+
+    python -m benchmarks.bench_codec --messages 1000
+"""
+import argparse
+import timeit
+from common.message import Chatmsg
+from common.protocol import Protocol, UINT32
+
+
+def make_messages(count):
+    return [Chatmsg("alice", "bob", f"message number {i}, how are you doing today?", timestamp=1700000000.0 + i)
+            for i in range(count)]
+
+def encode_generic(msgs):
+    """ the encoding used before the packed records: a list of 0x05 messages """
+    buf = bytearray()
+    buf.append(0x03)
+    buf += UINT32.pack(len(msgs))
+    for msg in msgs:
+        buf.append(0x05)
+        Protocol.encode_into(msg.to_dict(), buf)
+    return bytes(buf)
+
+def bench(label, fn, number):
+    seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print(f"  {label:<8} {seconds * 1e3:8.3f} ms")
+    return seconds
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    msgs = make_messages(args.messages)
+    generic = encode_generic(msgs)
+    packed = Protocol.encode_obj(msgs)
+    print(f"{args.messages} messages, payload {len(generic)} bytes generic, {len(packed)} bytes packed")
+
+    print("encode")
+    old = bench("generic", lambda: encode_generic(msgs), args.number)
+    new = bench("packed", lambda: Protocol.encode_obj(msgs), args.number)
+    print(f"  speedup  {old / new:8.2f}x")
+
+    print("decode")
+    old = bench("generic", lambda: Protocol.decode_obj(generic), args.number)
+    new = bench("packed", lambda: Protocol.decode_obj(packed), args.number)
+    print(f"  speedup  {old / new:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+measure how long the server takes to recover its state from disk
+
+    python -m benchmarks.bench_recovery --messages 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+from common.message import Chatmsg
+from server import handler, persistence
+
+
+def build_data_dir(path, num_messages, num_log_records, num_users):
+    """ a snapshot holding num_messages, plus a log of num_log_records sends after it """
+    users = [f"user_{i}" for i in range(num_users)]
+    snapshot_messages = [
+        Chatmsg(users[i % num_users], users[(i + 1) % num_users], f"message {i}", timestamp=float(i))
+        for i in range(num_messages)
+    ]
+    accounts = {username: "hash" for username in users}
+    persistence.write_snapshot(path, 1, {"accounts": accounts, "messages": snapshot_messages})
+
+    with open(persistence.log_path(path, 1), "wb") as f:
+        for i in range(num_log_records):
+            msg = Chatmsg(users[i % num_users], users[(i + 2) % num_users], f"logged {i}",
+                          timestamp=float(num_messages + i))
+            f.write(persistence.encode_record(["send", msg]))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200000, help="messages in the snapshot")
+    parser.add_argument("--log-records", type=int, default=50000, help="records in the log after the snapshot")
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        build_data_dir(path, args.messages, args.log_records, args.users)
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+        start = time.perf_counter()
+        handler.recover(path)
+        elapsed = time.perf_counter() - start
+
+    total = args.messages + args.log_records
+    print(f"recovered {len(handler.store.all_messages())} messages ({size / 2**20:.1f} MiB on disk) in {elapsed:.2f}s")
+    print(f"{total / elapsed:,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,26 @@
 import struct
 from common.message import Chatmsg
 
+INT64 = struct.Struct('!q')
+FLOAT64 = struct.Struct('!d')
+UINT32 = struct.Struct('!I')
+
+# fixed layout Chatmsg record: timestamp, status, then the byte lengths of
+# id, sender, recipient and content, followed by those utf-8 bytes
+CHATMSG_HEAD = struct.Struct('!dBHHHI')
+CHATMSG_STATUS_CODES = {"unread": 0, "read": 1}
+CHATMSG_STATUS_NAMES = ("unread", "read")
+MAX_SHORT_STR = 0xFFFF
+
+# decoder limits, a frame beyond them is rejected as malformed
+MAX_DEPTH = 32
+MAX_ELEMENTS = 1000000
+
+
+class ProtocolError(ValueError):
+    """ the data is not a valid encoding, or exceeds the decoder limits """
+
+
 class Protocol:
     # constant for message type
     # request
@@ -12,100 +32,263 @@ class Protocol:
     REQ_LIST_USERS = 6
     REQ_DELETE_MESSAGE = 7
     REQ_DELETE_ACCOUNT = 8
+    REQ_LIST_MESSAGES_PAGE = 9
+    REQ_STREAM_MESSAGES = 10
 
     # response
+    RESP_ERROR = 100
     RESP_USER_EXISTING = 101
     RESP_USER_NOT_EXISTING = 102
     RESP_LOGIN_SUCCESS = 103
     RESP_LOGIN_FAILED = 104
     RESP_LIST_MESSAGES = 105
     RESP_LIST_USERS = 106
+    RESP_LIST_MESSAGES_PAGE = 107
+    RESP_PUSH_MESSAGE = 108  # server initiated, a new Chatmsg for an online recipient
+    RESP_SERVER_BUSY = 109  # too many logins in progress, try again later
+    # a streamed list: any number of chunk frames (each a list), then an end frame (the item count)
+    RESP_MESSAGES_CHUNK = 110
+    RESP_MESSAGES_END = 111
+
+    @staticmethod
+    def chunked(items, chunk_size):
+        """
+        Group any iterable (e.g. a generator) into lists of at most chunk_size,
+        each sent as its own frame, so a long list is never built or encoded whole.
+        """
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
     @staticmethod
     def encode_obj(obj):
         """
         Serialize Python objects to binary format.
         """
+        buf = bytearray()
+        Protocol.encode_into(obj, buf)
+        return bytes(buf)
+
+    @staticmethod
+    def encode_into(obj, buf):
+        """
+        Append the binary format of obj to the bytearray buf,
+        nested objects are written into the same buffer.
+        """
         if isinstance(obj, int):
-            return b'\x00' + struct.pack('!q', obj)
+            buf.append(0x00)
+            buf += INT64.pack(obj)
 
         elif isinstance(obj, float):
-            return b'\x01' + struct.pack('!d', obj)  # 8-byte float
+            buf.append(0x01)
+            buf += FLOAT64.pack(obj)  # 8-byte float
 
         elif isinstance(obj, str):
             data = obj.encode('utf-8')
-            length = len(data)
-            return b'\x02' + struct.pack('!I', length) + data
+            buf.append(0x02)
+            buf += UINT32.pack(len(data))
+            buf += data
 
         elif isinstance(obj, list):
-            encoded_items = [Protocol.encode_obj(item) for item in obj]
-            return b'\x03' + struct.pack('!I', len(obj)) + b''.join(encoded_items)
+            # a list of messages (e.g. RESP_LIST_MESSAGES) uses packed records
+            if obj and all(type(item) is Chatmsg for item in obj) and Protocol.encode_chatmsg_list(obj, buf):
+                return
+            buf.append(0x03)
+            buf += UINT32.pack(len(obj))
+            for item in obj:
+                Protocol.encode_into(item, buf)
 
         elif isinstance(obj, dict):
-            encoded_items = []
+            buf.append(0x04)
+            buf += UINT32.pack(len(obj))
             for k, v in obj.items():
-                encoded_key = Protocol.encode_obj(str(k))
-                encoded_value = Protocol.encode_obj(v)
-                encoded_items.append(encoded_key + encoded_value)
-            return b'\x04' + struct.pack('!I', len(obj)) + b''.join(encoded_items)
+                Protocol.encode_into(str(k), buf)
+                Protocol.encode_into(v, buf)
 
         elif isinstance(obj, Chatmsg):
-            # Define Chatmsg as type 0x04, then encode it as a dictionary
-            encoded_chatmsg = Protocol.encode_obj(obj.to_dict())
-            return b'\x05' + encoded_chatmsg
+            buf.append(0x06)
+            if Protocol.encode_chatmsg_record(obj, buf):
+                return
+            # a message the fixed layout can't hold: type 0x05, encoded as a dictionary
+            del buf[-1]
+            buf.append(0x05)
+            Protocol.encode_into(obj.to_dict(), buf)
 
         else:
             raise TypeError(f"Unsupported type: {type(obj)}")
 
     @staticmethod
-    def decode_obj(data, offset=0):
+    def encode_chatmsg_record(msg, buf):
+        """
+        Append msg in the fixed record layout (without a type code).
+        Returns False and leaves buf as it was if the layout can't hold it.
+        """
+        status = CHATMSG_STATUS_CODES.get(msg.status)
+        msg_id = msg.id.encode('utf-8')
+        sender = msg.sender.encode('utf-8')
+        recipient = msg.recipient.encode('utf-8')
+        if status is None or max(len(msg_id), len(sender), len(recipient)) > MAX_SHORT_STR:
+            return False
+        content = msg.content.encode('utf-8')
+        buf += CHATMSG_HEAD.pack(msg.timestamp, status, len(msg_id), len(sender), len(recipient), len(content))
+        buf += msg_id
+        buf += sender
+        buf += recipient
+        buf += content
+        return True
+
+    @staticmethod
+    def encode_chatmsg_list(msgs, buf):
+        """
+        Append a list of messages as type 0x07: count, then one record per message.
+        Returns False and leaves buf as it was if a message doesn't fit the layout.
+        """
+        start = len(buf)
+        buf.append(0x07)
+        buf += UINT32.pack(len(msgs))
+        for msg in msgs:
+            if not Protocol.encode_chatmsg_record(msg, buf):
+                del buf[start:]
+                return False
+        return True
+
+    @staticmethod
+    def decode_chatmsg_record(data, offset):
+        timestamp, status, id_len, sender_len, recipient_len, content_len = CHATMSG_HEAD.unpack_from(data, offset)
+        offset += CHATMSG_HEAD.size
+        if offset + id_len + sender_len + recipient_len + content_len > len(data):
+            raise ProtocolError("Truncated message record")
+        msg_id = str(data[offset:offset + id_len], 'utf-8')
+        offset += id_len
+        sender = str(data[offset:offset + sender_len], 'utf-8')
+        offset += sender_len
+        recipient = str(data[offset:offset + recipient_len], 'utf-8')
+        offset += recipient_len
+        content = str(data[offset:offset + content_len], 'utf-8')
+        offset += content_len
+        msg = Chatmsg(sender, recipient, content, msg_id=msg_id, timestamp=timestamp,
+                      status=CHATMSG_STATUS_NAMES[status])
+        return msg, offset
+
+    @staticmethod
+    def decode_obj(data, offset=0, max_depth=MAX_DEPTH, max_elements=MAX_ELEMENTS):
         """
         Deserialize binary data back to Python objects.
+        Nested lists and dicts are tracked on an explicit stack instead of by
+        recursion. Frames nested deeper than max_depth, declaring more than
+        max_elements items in total (None: no limit), or whose counts can't
+        fit in the remaining bytes raise ProtocolError before anything big is built.
         """
-        type_code = data[offset]
-        offset += 1
-
-        if type_code == 0x00:
-            (val,) = struct.unpack_from('!q', data, offset)
-            offset += 8
-            return val, offset
-
-        elif type_code == 0x01:
-            (val,) = struct.unpack_from('!d', data, offset) 
-            offset += 8
-            return val, offset
-
-        elif type_code == 0x02:
-            (str_len,) = struct.unpack_from('!I', data, offset)
-            offset += 4
-            s = data[offset:offset + str_len].decode('utf-8')
-            offset += str_len
-            return s, offset
-
-        elif type_code == 0x03:
-            (list_size,) = struct.unpack_from('!I', data, offset)
-            offset += 4
-            arr = []
-            for _ in range(list_size):
-                item, offset = Protocol.decode_obj(data, offset)
-                arr.append(item)
-            return arr, offset
-
-        elif type_code == 0x04:
-            (dict_size,) = struct.unpack_from('!I', data, offset)
-            offset += 4
-            d = {}
-            for _ in range(dict_size):
-                key, offset = Protocol.decode_obj(data, offset)
-                value, offset = Protocol.decode_obj(data, offset)
-                d[key] = value
-            return d, offset
-
-        elif type_code == 0x05:
-            # Decode dictionary first, then convert to Chatmsg
-            chatmsg_dict, offset = Protocol.decode_obj(data, offset)
-            return Chatmsg.from_dict(chatmsg_dict), offset
+        try:
+            return Protocol.decode_iterative(data, offset, max_depth, max_elements)
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise ProtocolError(f"Malformed data: {e}") from e
 
-        else:
-            raise ValueError(f"Unknown type code: {type_code}")
+    @staticmethod
+    def decode_iterative(data, offset, max_depth, max_elements):
+        end = len(data)
+        elements = 0
+        # containers being filled: [kind, container, items left, pending dict key]
+        stack = []
+        # bound once, looked up for every item otherwise
+        unpack_int64 = INT64.unpack_from
+        unpack_float64 = FLOAT64.unpack_from
+        unpack_uint32 = UINT32.unpack_from
+
+        while True:
+            type_code = data[offset]
+            offset += 1
+
+            if type_code == 0x00:
+                (val,) = unpack_int64(data, offset)
+                offset += 8
+
+            elif type_code == 0x01:
+                (val,) = unpack_float64(data, offset)
+                offset += 8
+
+            elif type_code == 0x02:
+                (str_len,) = unpack_uint32(data, offset)
+                offset += 4
+                if offset + str_len > end:
+                    raise ProtocolError("Truncated string")
+                # str() accepts bytes and memoryview alike
+                val = str(data[offset:offset + str_len], 'utf-8')
+                offset += str_len
+
+            elif type_code == 0x03 or type_code == 0x04:
+                (size,) = unpack_uint32(data, offset)
+                offset += 4
+                # every item takes at least one byte (a dict entry two)
+                min_bytes = size if type_code == 0x03 else 2 * size
+                if min_bytes > end - offset:
+                    raise ProtocolError(f"Container of {size} items does not fit in the data")
+                elements += size
+                if max_elements is not None and elements > max_elements:
+                    raise ProtocolError(f"More than {max_elements} elements")
+                val = [] if type_code == 0x03 else {}
+                if size:
+                    if len(stack) >= max_depth:
+                        raise ProtocolError(f"Nested deeper than {max_depth}")
+                    stack.append([type_code, val, size, None])
+                    continue
+
+            elif type_code == 0x05:
+                # a dictionary follows, converted to Chatmsg once complete
+                if len(stack) >= max_depth:
+                    raise ProtocolError(f"Nested deeper than {max_depth}")
+                stack.append([0x05, None, 1, None])
+                continue
+
+            elif type_code == 0x06:
+                val, offset = Protocol.decode_chatmsg_record(data, offset)
+
+            elif type_code == 0x07:
+                (size,) = unpack_uint32(data, offset)
+                offset += 4
+                if size * CHATMSG_HEAD.size > end - offset:
+                    raise ProtocolError(f"List of {size} messages does not fit in the data")
+                elements += size
+                if max_elements is not None and elements > max_elements:
+                    raise ProtocolError(f"More than {max_elements} elements")
+                val = []
+                for _ in range(size):
+                    msg, offset = Protocol.decode_chatmsg_record(data, offset)
+                    val.append(msg)
+
+            else:
+                raise ProtocolError(f"Unknown type code: {type_code}")
 
+            # hand the value to the innermost open container, closing the full ones
+            while stack:
+                frame = stack[-1]
+                kind = frame[0]
+                if kind == 0x03:
+                    frame[1].append(val)
+                elif kind == 0x04:
+                    if frame[3] is None:
+                        if not isinstance(val, str):
+                            raise ProtocolError("Dictionary keys must be strings")
+                        frame[3] = val
+                        break
+                    frame[1][frame[3]] = val
+                    frame[3] = None
+                else:
+                    if not isinstance(val, dict):
+                        raise ProtocolError("Chatmsg must be encoded as a dictionary")
+                    try:
+                        frame[1] = Chatmsg.from_dict(val)
+                    except KeyError as e:
+                        raise ProtocolError(f"Chatmsg without {e}") from e
+                frame[2] -= 1
+                if frame[2]:
+                    break
+                stack.pop()
+                val = frame[1]
+            else:
+                return val, offset
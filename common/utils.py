@@ -1,43 +1,214 @@
+import asyncio
 import json
 import struct
 import bcrypt
-from common.protocol import Protocol
+from common.protocol import Protocol, ProtocolError
 from common.message import Chatmsg
 
-def recv_data(sock):
+# frame header: int64 msg_type + uint32 data_len
+HEADER = struct.Struct("!QI")
+
+# larger frames are refused before their payload is read
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+def check_frame_size(data_len, max_frame_size):
+    if data_len > max_frame_size:
+        raise ProtocolError(f"Frame of {data_len} bytes exceeds the limit of {max_frame_size}")
+
+def recv_exactly(sock, n):
+    """ read exactly n bytes, None if the connection closes first """
+    buf = bytearray(n)
+    view = memoryview(buf)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            return None
+        received += count
+    return buf
+
+def recv_data(sock, max_frame_size=MAX_FRAME_SIZE):
     # receive 12 bytes header
-    header = sock.recv(12)
-    if len(header) < 12:
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
         return None, None
 
     # parse header
-    msg_type, data_len = struct.unpack("!QI", header)
+    msg_type, data_len = HEADER.unpack(header)
+    check_frame_size(data_len, max_frame_size)
 
     if data_len == 0:
         return msg_type, None
     
     # read payload
-    payload = b""
-    while len(payload) < data_len:
-        chunk = sock.recv(data_len - len(payload))
-        if not chunk:
-            return None, None 
-        payload += chunk
+    payload = recv_exactly(sock, data_len)
+    if payload is None:
+        return None, None
+
+    obj, _ = Protocol.decode_obj(payload)
+    return msg_type, obj
+
+class FrameReader:
+    """
+    buffered reader for one connection. a single recv_into can bring in
+    several pipelined frames, they are decoded straight from the buffer
+    through a memoryview, without copying the payload
+    """
+    def __init__(self, sock, bufsize=65536, max_frame_size=MAX_FRAME_SIZE):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.max_frame_size = max_frame_size
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first byte not handed out yet
+        self.end = 0    # end of the received bytes
+
+    def buffered(self):
+        return self.end - self.start
+
+    def make_room(self, needed):
+        """ make sure needed bytes fit in the buffer from self.start on """
+        if self.start + needed <= len(self.buf):
+            return
+        size = self.buffered()
+        if needed <= len(self.buf):
+            # move the unread bytes to the front, same size so the view stays valid
+            self.buf[:size] = self.buf[self.start:self.end]
+        else:
+            # a frame larger than the buffer
+            buf = bytearray(max(needed, 2 * len(self.buf)))
+            buf[:size] = self.buf[self.start:self.end]
+            self.view.release()
+            self.buf = buf
+            self.view = memoryview(buf)
+        self.start = 0
+        self.end = size
+
+    def fill(self, needed):
+        """ receive until needed bytes are buffered, False if the connection closes first """
+        if self.buffered() >= needed:
+            return True
+        self.make_room(needed)
+        while self.buffered() < needed:
+            count = self.sock.recv_into(self.view[self.end:])
+            if count == 0:
+                return False
+            self.end += count
+        return True
+
+    def has_frame(self):
+        """ whether a complete frame is buffered, so read_frame won't block """
+        if self.buffered() < HEADER.size:
+            return False
+        _, data_len = HEADER.unpack_from(self.buf, self.start)
+        return self.buffered() >= HEADER.size + data_len
+
+    def read_frame(self):
+        """ next (msg_type, obj), or (None, None) once the connection is closed """
+        if not self.fill(HEADER.size):
+            return None, None
+        msg_type, data_len = HEADER.unpack_from(self.buf, self.start)
+        check_frame_size(data_len, self.max_frame_size)
+        if not self.fill(HEADER.size + data_len):
+            return None, None
+
+        payload_start = self.start + HEADER.size
+        self.start = payload_start + data_len
+        obj = None
+        if data_len:
+            obj, _ = Protocol.decode_obj(self.view[payload_start:self.start])
+
+        if self.start == self.end:
+            self.start = self.end = 0
+            # don't keep a buffer grown for one huge frame
+            if len(self.buf) > 4 * self.bufsize:
+                self.view.release()
+                self.buf = bytearray(self.bufsize)
+                self.view = memoryview(self.buf)
+        return msg_type, obj
+
+async def recv_data_async(reader, max_frame_size=MAX_FRAME_SIZE):
+    """
+    same framing as recv_data, but reads from an asyncio StreamReader
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+        msg_type, data_len = HEADER.unpack(header)
+        check_frame_size(data_len, max_frame_size)
+
+        if data_len == 0:
+            return msg_type, None
+
+        payload = await reader.readexactly(data_len)
+    except asyncio.IncompleteReadError:
+        return None, None
 
     obj, _ = Protocol.decode_obj(payload)
     return msg_type, obj
 
+def encode_frame(msg_type, data):
+    """ header and payload encoded into one buffer, no concatenation """
+    frame = bytearray(HEADER.size)
+    if data is not None:
+        Protocol.encode_into(data, frame)
+    HEADER.pack_into(frame, 0, msg_type, len(frame) - HEADER.size)
+    return frame
+
 def send_data(sock, msg_type, data):
-    if data is None:
-        payload = b""
-    else:
-        payload = Protocol.encode_obj(data)
-    data_len = len(payload)
-    header = struct.pack('!QI', msg_type, data_len)
-    sock.sendall(header + payload)    
+    sock.sendall(encode_frame(msg_type, data))
+
+def send_stream(sock, chunk_type, end_type, chunks):
+    """ send each list from chunks as one frame, then the end frame with the item count """
+    count = 0
+    for chunk in chunks:
+        send_data(sock, chunk_type, chunk)
+        count += len(chunk)
+    send_data(sock, end_type, count)
+    return count
+
+def iter_stream(recv, chunk_type, end_type):
+    """
+    yield the items of a streamed list as its chunks arrive, recv is a
+    function returning the next (msg_type, obj), like recv_data
+    """
+    while True:
+        msg_type, obj = recv()
+        if msg_type == chunk_type:
+            yield from obj
+        elif msg_type == end_type:
+            return
+        elif msg_type is None:
+            raise ConnectionError("Connection closed in the middle of a stream")
+        else:
+            raise ProtocolError(f"Unexpected frame {msg_type} in a stream")
+
+# most systems refuse sendmsg calls with more buffers than this (IOV_MAX)
+MAX_SEGMENTS = 1024
 
-def hash_pwd(password):
-    salt = bcrypt.gensalt()
+def send_segments(sock, segments):
+    """
+    send a list of buffers with as few syscalls as possible (vectored
+    sendmsg), falls back to one joined sendall where sendmsg is missing
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(segments))
+        return
+    segments = list(segments)
+    index = 0
+    while index < len(segments):
+        sent = sock.sendmsg(segments[index:index + MAX_SEGMENTS])
+        # skip what went out, keep the unsent tail of a partly sent buffer
+        while index < len(segments) and sent >= len(segments[index]):
+            sent -= len(segments[index])
+            index += 1
+        if sent:
+            segments[index] = memoryview(segments[index])[sent:]
+
+# bcrypt cost factor, every +1 doubles the time a hash takes
+BCRYPT_ROUNDS = 12
+
+def hash_pwd(password, rounds=BCRYPT_ROUNDS):
+    salt = bcrypt.gensalt(rounds)
     hashed = bcrypt.hashpw(password.encode(), salt)
     return hashed.decode()  
 
@@ -67,22 +238,20 @@ def decode_json(obj):
         return [decode_json(item) for item in obj] 
     return obj  
 
-def recv_data_json(sock):
-    header = sock.recv(12)
-    if len(header) < 12:
+def recv_data_json(sock, max_frame_size=MAX_FRAME_SIZE):
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
         return None, None
 
-    msg_type, data_len = struct.unpack("!QI", header)
+    msg_type, data_len = HEADER.unpack(header)
+    check_frame_size(data_len, max_frame_size)
 
     if data_len == 0:
         return msg_type, None
     
-    payload = b""
-    while len(payload) < data_len:
-        chunk = sock.recv(data_len - len(payload))
-        if not chunk:
-            return None, None 
-        payload += chunk
+    payload = recv_exactly(sock, data_len)
+    if payload is None:
+        return None, None
 
     try:
         obj = json.loads(payload.decode('utf-8'))
@@ -90,4 +259,4 @@ def recv_data_json(sock):
     except json.JSONDecodeError:
         return None, None  
 
-    return msg_type, obj
\ No newline at end of file
+    return msg_type, obj
@@ -1,11 +1,19 @@
 import tkinter as tk
 from tkinter import messagebox
+import queue
 import socket
+import threading
 from common.protocol import Protocol
 from common.utils import send_data, recv_data
 from common.message import Chatmsg
 
 
+# number of messages fetched per history request
+PAGE_SIZE = 50
+# how often the Tk loop picks up pushed messages, in ms
+PUSH_POLL_INTERVAL = 100
+
+
 class ChatClientApp:
     def __init__(self, root, host='127.0.0.1', port=5000):
         self.root = root
@@ -14,10 +22,52 @@ class ChatClientApp:
         self.client_socket = None
         self.username = None
         self.protocol = Protocol()
+        # messages of the chat currently on screen, sorted by time
+        self.chat_messages = []
+        # filled by the background reader: replies to our requests, and messages pushed by the server
+        self.responses = queue.Queue()
+        self.pushed_messages = queue.Queue()
 
         self.current_screen = None
 
         self.login_screen()
+        self.poll_pushed_messages()
+
+    def reader_loop(self, sock, responses):
+        """
+        background reader: the server can push messages at any time, so every
+        frame is read here and routed to the right queue
+        """
+        try:
+            while True:
+                resp_type, resp = recv_data(sock)
+                if resp_type is None:
+                    break
+                if resp_type == Protocol.RESP_PUSH_MESSAGE:
+                    self.pushed_messages.put(resp)
+                else:
+                    responses.put((resp_type, resp))
+        except OSError:
+            pass
+        # wake up anyone waiting for a reply
+        responses.put((None, None))
+
+    def recv_response(self):
+        return self.responses.get()
+
+    def poll_pushed_messages(self):
+        # runs on the Tk thread, widgets must not be touched from the reader
+        while not self.pushed_messages.empty():
+            self.on_pushed_message(self.pushed_messages.get())
+        self.root.after(PUSH_POLL_INTERVAL, self.poll_pushed_messages)
+
+    def on_pushed_message(self, message):
+        if self.current_screen != f"chat_{message.sender}":
+            return
+        if any(msg.id == message.id for msg in self.chat_messages):
+            return
+        self.chat_messages.append(message)
+        self.message_listbox.insert(tk.END, f"{message.sender}: {message.content}")
 
     def login_screen(self):
         # Clear the screen
@@ -44,12 +94,15 @@ class ChatClientApp:
         self.username = username
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.connect((self.host, self.port))
+        # fresh queue, so a reader left over from a failed login cannot answer for this socket
+        self.responses = queue.Queue()
+        threading.Thread(target=self.reader_loop, args=(self.client_socket, self.responses), daemon=True).start()
         
         # Phase 1: Send username for login
         send_data(self.client_socket, Protocol.REQ_LOGIN_1, username)
         
         # Receive response for username
-        resp_type, resp = recv_data(self.client_socket)
+        resp_type, resp = self.recv_response()
         print(f"Received response: {resp_type}, {resp}")  # debugging output
         
         if resp_type == Protocol.RESP_USER_EXISTING:
@@ -86,12 +139,15 @@ class ChatClientApp:
         send_data(self.client_socket, Protocol.REQ_LOGIN_2, password)
 
         # Receive response for password
-        resp_type, resp = recv_data(self.client_socket)
+        resp_type, resp = self.recv_response()
         if resp_type == Protocol.RESP_LOGIN_SUCCESS:
             self.show_user_list_screen()
         elif resp_type == Protocol.RESP_LOGIN_FAILED:
             messagebox.showerror("Login Failed", "Invalid username or password.")
             self.client_socket.close()
+        elif resp_type == Protocol.RESP_SERVER_BUSY:
+            # the connection stays open, submitting again retries
+            messagebox.showwarning("Server Busy", "The server is busy, please try again.")
         else:
             messagebox.showerror("Login Error", "Unexpected response from server.")
             self.client_socket.close()
@@ -104,7 +160,7 @@ class ChatClientApp:
 
         # Request the list of users
         send_data(self.client_socket, Protocol.REQ_LIST_USERS, None)
-        resp_type, resp = recv_data(self.client_socket)
+        resp_type, resp = self.recv_response()
 
         if resp_type == Protocol.RESP_LIST_USERS:
             self.users = resp
@@ -122,17 +178,49 @@ class ChatClientApp:
             self.user_buttons[user] = button
 
     def show_message_list(self, username):
+        # Request only the newest page of messages for the selected user
+        self.chat_messages = self.fetch_message_page(username) or []
+        self.render_message_list(username)
+
+    def fetch_message_page(self, username, before=None, after=None):
+        request = {"friend": username, "limit": PAGE_SIZE}
+        if before is not None:
+            request["before"] = before
+        if after is not None:
+            request["after"] = after
+        send_data(self.client_socket, Protocol.REQ_LIST_MESSAGES_PAGE, request)
+        resp_type, resp = self.recv_response()
+
+        if resp_type == Protocol.RESP_LIST_MESSAGES_PAGE:
+            return resp
+        return None
+
+    def load_earlier_messages(self, username):
+        if not self.chat_messages:
+            return
+        page = self.fetch_message_page(username, before=self.chat_messages[0].timestamp)
+        if page:
+            self.chat_messages = page + self.chat_messages
+            self.render_message_list(username)
+
+    def refresh_message_list(self, username):
+        # only download what is newer than the last message on screen
+        if not self.chat_messages:
+            self.show_message_list(username)
+            return
+        page = self.fetch_message_page(username, after=self.chat_messages[-1].timestamp)
+        if page:
+            # some of them may already have been pushed to us
+            known_ids = {msg.id for msg in self.chat_messages}
+            self.chat_messages.extend(msg for msg in page if msg.id not in known_ids)
+        self.render_message_list(username)
+
+    def render_message_list(self, username):
         # Clear the screen
         self.clear_screen()
 
         self.current_screen = f"chat_{username}"
-
-        # Request the list of messages for the selected user
-        send_data(self.client_socket, Protocol.REQ_LIST_MESSAGES, username)
-        resp_type, resp = recv_data(self.client_socket)
-
-        if resp_type == Protocol.RESP_LIST_MESSAGES:
-            self.display_messages(resp, username)
+        self.display_messages(self.chat_messages, username)
 
     def on_message_click(self, event, messages, username):
         try:
@@ -148,6 +236,9 @@ class ChatClientApp:
         self.chat_label = tk.Label(self.root, text=f"Chat with {username}:")
         self.chat_label.pack()
 
+        self.earlier_button = tk.Button(self.root, text="Load earlier", command=lambda: self.load_earlier_messages(username))
+        self.earlier_button.pack()
+
         self.message_listbox = tk.Listbox(self.root, height=10, width=50)
         self.message_listbox.pack()
 
@@ -185,15 +276,16 @@ class ChatClientApp:
 
         send_data(self.client_socket, Protocol.REQ_SEND_MSG, [recipient, message])
 
-        # Refresh message list after sending the message
-        self.show_message_list(recipient)
+        # Fetch the new message after sending it
+        self.refresh_message_list(recipient)
 
     def delete_message(self, msg_id, recipient):
 
         send_data(self.client_socket, Protocol.REQ_DELETE_MESSAGE, msg_id)
 
-        # Refresh message list after sending the message
-        self.show_message_list(recipient)
+        # The server has nothing new for us, drop the message locally
+        self.chat_messages = [msg for msg in self.chat_messages if msg.id != msg_id]
+        self.render_message_list(recipient)
 
     def delete_account(self):
         send_data(self.client_socket, Protocol.REQ_DELETE_ACCOUNT, None)
@@ -0,0 +1,60 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+import threading
+from common.utils import hash_pwd, check_pwd, BCRYPT_ROUNDS
+
+
+class PasswordPoolBusy(Exception):
+    """ too many password jobs are queued already """
+
+
+class PasswordPool:
+    """
+    runs bcrypt in worker processes, so a login storm uses every core and
+    does not hold up message traffic. at most max_pending jobs are queued
+    or running, beyond that new jobs are refused
+    """
+    def __init__(self, workers=None, max_pending=64, rounds=BCRYPT_ROUNDS):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.rounds = rounds
+
+    def submit(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PasswordPoolBusy()
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def hash_pwd(self, password):
+        return self.submit(hash_pwd, password, self.rounds)
+
+    def check_pwd(self, password, hashed_password):
+        return self.submit(check_pwd, password, hashed_password)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class InlinePasswordHasher:
+    """ same interface as PasswordPool, but does the work in the calling thread """
+    def __init__(self, rounds=BCRYPT_ROUNDS):
+        self.rounds = rounds
+
+    @staticmethod
+    def done(result):
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def hash_pwd(self, password):
+        return self.done(hash_pwd(password, self.rounds))
+
+    def check_pwd(self, password, hashed_password):
+        return self.done(check_pwd(password, hashed_password))
+
+    def shutdown(self):
+        pass
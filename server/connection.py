@@ -0,0 +1,96 @@
+import asyncio
+import threading
+from common.utils import send_segments
+
+# a corked connection still sends once this much is queued, so large or
+# streamed replies don't pile up in memory
+CORK_LIMIT = 256 * 1024
+
+
+class ThreadedConnection:
+    """
+    blocking socket shared by its client thread and by threads pushing
+    messages to it. frames are queued and written by one flusher at a time,
+    so they never interleave, and frames queued meanwhile (or while the
+    connection is corked) go out together in one vectored send
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.queue_lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.flushing = False
+        self.corked = False
+
+    def recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    def recv_into(self, buffer):
+        return self.sock.recv_into(buffer)
+
+    def held_back(self):
+        """ caller holds queue_lock """
+        return self.corked and self.pending_bytes < CORK_LIMIT
+
+    def sendall(self, data):
+        with self.queue_lock:
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+            if self.flushing or self.held_back():
+                # whoever is flushing, or uncork(), will send it
+                return
+            self.flushing = True
+        self.flush()
+
+    def flush(self):
+        """ send queued frames until the queue is empty, caller has set self.flushing """
+        try:
+            while True:
+                with self.queue_lock:
+                    if not self.pending or self.held_back():
+                        self.flushing = False
+                        return
+                    segments, self.pending = self.pending, []
+                    self.pending_bytes = 0
+                send_segments(self.sock, segments)
+        except BaseException:
+            with self.queue_lock:
+                self.flushing = False
+            raise
+
+    def cork(self):
+        """ hold back frames, e.g. while answering a batch of pipelined requests """
+        with self.queue_lock:
+            self.corked = True
+
+    def uncork(self):
+        with self.queue_lock:
+            self.corked = False
+            if self.flushing or not self.pending:
+                return
+            self.flushing = True
+        self.flush()
+
+    def close(self):
+        self.sock.close()
+
+
+class AsyncConnection:
+    """
+    socket-like wrapper around an asyncio StreamWriter, so handle_request
+    and send_data can write to it exactly like a blocking socket
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+
+    def sendall(self, data):
+        # buffered by the transport, flushed when the entry loop drains
+        if threading.get_ident() == self.loop_thread:
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def close(self):
+        self.writer.close()
@@ -1,20 +1,97 @@
-from collections import deque, defaultdict
+from contextlib import contextmanager, ExitStack
+import os
 import threading
-from common.utils import recv_data, send_data, check_pwd, hash_pwd
+import asyncio
+from common.utils import FrameReader, recv_data_async, send_data, send_stream, BCRYPT_ROUNDS
 from common.protocol import Protocol
 from common.message import Chatmsg
+from server.connection import AsyncConnection, ThreadedConnection
+from server import persistence
+from server.storage import MemoryStore
+from server.auth import InlinePasswordHasher, PasswordPool, PasswordPoolBusy
 
 # dict mapping client addr to username
 connected_clients = {}
 
+# presence: dict mapping logged in username to its sessions {username: {addr: connection}}
+online_users = {}
+
 # dict mapping username to password
 user_accounts = {}
 
-# global message store 
-message_store = {}  # {msg_id: Message}
-messages = defaultdict(lambda: defaultdict(deque))  # {sender: {recipient: deque([msg_id1, msg_id2, ...])}}
+# bcrypt work for REQ_LOGIN_2, see enable_password_pool
+password_hasher = InlinePasswordHasher()
+
+# global message store, see server/storage.py for the backends
+store = MemoryStore()
+
+# state of a user (messages it received, unread counts, sessions) is guarded by
+# the shard lock its name hashes to; an operation on a conversation takes the
+# locks of both users, so unrelated conversations proceed in parallel
+NUM_LOCK_SHARDS = 64
+shard_locks = [threading.Lock() for _ in range(NUM_LOCK_SHARDS)]
+
+# write-ahead log of state changes, None when the server keeps everything in memory only
+message_log = None
+data_dir = None
+# take a snapshot (and start a new log file) after this many log records
+SNAPSHOT_EVERY = 100000
+snapshot_every = SNAPSHOT_EVERY
+snapshot_needed = threading.Event()
+
+# page size for REQ_LIST_MESSAGES_PAGE
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# messages per frame for REQ_STREAM_MESSAGES
+STREAM_CHUNK_SIZE = 200
 
-lock = threading.Lock()
+@contextmanager
+def locked(*usernames):
+    """ hold the shard locks of the given users, always taken in index order to avoid deadlocks """
+    indexes = sorted({hash(username) % NUM_LOCK_SHARDS for username in usernames})
+    with ExitStack() as stack:
+        for index in indexes:
+            stack.enter_context(shard_locks[index])
+        yield
+
+@contextmanager
+def locked_all():
+    """ hold every shard lock, for operations that touch all users """
+    with ExitStack() as stack:
+        for shard_lock in shard_locks:
+            stack.enter_context(shard_lock)
+        yield
+
+def set_store(new_store):
+    """ switch to another storage backend, accounts it keeps are loaded """
+    global store
+    store.close()
+    store = new_store
+    user_accounts.update(store.load_accounts())
+
+def enable_password_pool(workers=None, max_pending=64, rounds=BCRYPT_ROUNDS):
+    """
+    hash and check passwords in worker processes instead of the connection's thread,
+    workers=0 keeps doing it inline
+    """
+    global password_hasher
+    password_hasher.shutdown()
+    if workers == 0:
+        password_hasher = InlinePasswordHasher(rounds)
+    else:
+        password_hasher = PasswordPool(workers, max_pending, rounds)
+
+def set_online(username, address, sock):
+    with locked(username):
+        online_users.setdefault(username, {})[address] = sock
+
+def set_offline(username, address):
+    with locked(username):
+        sessions = online_users.get(username)
+        if sessions is not None:
+            sessions.pop(address, None)
+            if not sessions:
+                del online_users[username]
 
 def handle_new_connection(address):
     print(f"[INFO] Client connected from {address}")
@@ -23,129 +100,266 @@ def handle_new_connection(address):
 
 def handle_disconnect(client_socket, address):
     if address in connected_clients:
+        set_offline(connected_clients[address], address)
         del connected_clients[address]
     client_socket.close()
     print(f"[INFO] Client disconnected.")
 
 
+def push_message(sock, msg):
+    try:
+        send_data(sock, Protocol.RESP_PUSH_MESSAGE, msg)
+    except OSError as e:
+        # the reader of that connection will notice and clean up
+        print(f"[ERROR] push to {msg.recipient} failed: {e}")
+
 def send_message(sender, recipient, content):
     """ send message:
     - online user:directly send messages
     - offline user: store into undelivered_messages
     """
-    with lock:
+    online_sockets = []
+    with locked(sender, recipient):
         msg = Chatmsg(sender, recipient, content)
-        message_store[msg.id] = msg  # global storage for messages
-
-        messages[recipient][sender].append(msg.id)
         
-        if recipient in connected_clients.values():  # if recipient is online
+        if recipient in online_users:  # if recipient is online
             print(f"✅ Message delivered to {recipient}")
             msg.status = 'read'
+            online_sockets = list(online_users[recipient].values())
         else:  # recipient is offline
             print(f"📩 {recipient} is offline. Message stored for later delivery.")
 
+        store.add_message(msg)
+        log_event("send", msg)
+
+    # socket writes happen outside the lock
+    for sock in online_sockets:
+        push_message(sock, msg)
+
 
 def read_messages(sender, recipient):
-    with lock:
-        if recipient not in messages or sender not in messages[recipient]:
+    with locked(sender, recipient):
+        if not store.mark_read(sender, recipient):
             print(f"🚫 No messages from {sender} to {recipient}.")
             return
+        log_event("read", sender, recipient)
+
+def list_messages(username, friend):
+    """ messages between username and friend, sorted by time """
+    with locked(username, friend):
+        return store.list_messages(username, friend)
 
-        message_ids = list(messages[recipient][sender])
+def list_messages_page(username, friend, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    at most limit messages between username and friend, sorted by time:
+    - after: the oldest messages newer than the cursor
+    - before: the newest messages older than the cursor
+    - no cursor: the newest messages
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    with locked(username, friend):
+        return store.list_messages_page(username, friend, before=before, after=after, limit=limit)
 
-        for msg_id in message_ids:
-            if msg_id in message_store:
-                message_store[msg_id].status = "read"
+def iter_conversation(username, friend, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    generator over the messages between username and friend, sorted by time.
+    it reads one page at a time, holding the locks only while reading it
+    """
+    chunk_size = max(1, min(chunk_size, MAX_PAGE_SIZE))
+    page = list_messages_page(username, friend, after=0.0, limit=chunk_size)
+    while page:
+        yield from page
+        if len(page) < chunk_size:
+            return
+        last = page[-1]
+        try:
+            page = list_messages_page(username, friend, after=last.id, limit=chunk_size)
+        except ValueError:
+            # the last message was deleted meanwhile, go on from its timestamp
+            page = list_messages_page(username, friend, after=last.timestamp, limit=chunk_size)
 
-def list_messages(username, friend):
-    ret = []
-    for msg in message_store.values():
-        # my message to this friend 
-        if msg.sender == username and msg.recipient == friend:
-            ret.append(msg)
-        # this frind's message to me
-        if msg.sender == friend and msg.recipient == username:
-            ret.append(msg)
-    
-    # sort mseeage by time
-    sorted(ret, key= lambda msg : msg.timestamp)
-    return ret
+def stream_request(parsed_obj):
+    """ (friend, chunk_size) of a REQ_STREAM_MESSAGES payload {"friend": str, "chunk_size": int} """
+    chunk_size = parsed_obj.get("chunk_size", STREAM_CHUNK_SIZE)
+    return parsed_obj["friend"], max(1, min(chunk_size, MAX_PAGE_SIZE))
 
 def list_users(username):
-    unread_msg_cnt = {}
-    for sender in user_accounts.keys():
-        msg_queue = messages[username][sender]
-        count = 0
-        for msg_id in msg_queue:
-            msg = message_store[msg_id]
-            if msg.status == "unread":
-                count += 1
-        unread_msg_cnt[sender] = count
-    
-    return unread_msg_cnt
+    with locked(username):
+        counts = store.count_unread(username)
+    # list() copies the keys in one step, accounts may be created meanwhile
+    return {sender: counts.get(sender, 0) for sender in list(user_accounts)}
 
 def delete_message(username, msg_id):
-    with lock:
-        if msg_id in message_store:
-            recipient = message_store[msg_id].recipient
-            del message_store[msg_id]
-
-            messages[recipient][username].remove(msg_id)
-            print(f"🗑️ Deleted message {msg_id} from {username} to {recipient}")
+    msg = store.get_message(msg_id)
+    if msg is None:
+        return
+    recipient = msg.recipient
+    with locked(username, recipient):
+        # None if deleted by someone else meanwhile, or not sent by username
+        if store.delete_message(username, msg_id) is None:
+            return
+        log_event("delete", username, msg_id)
+        print(f"🗑️ Deleted message {msg_id} from {username} to {recipient}")
 
 def delete_account(username):
-    with lock:
+    with locked_all():
         if username in user_accounts:
             del user_accounts[username]
-        if username in messages:
-            for sender in list(messages[username].keys()):  # iterate message this user received
-                for msg_id in messages[username][sender]: 
-                    if msg_id in message_store:
-                        del message_store[msg_id]   
-            del messages[username] 
-
-        for recipient in list(messages.keys()):  # iterate message this user sended
-            if username in messages[recipient]:  # if user is sender
-                for msg_id in messages[recipient][username]: 
-                    if msg_id in message_store:
-                        del message_store[msg_id]
-                del messages[recipient][username]  # 删除 user 作为 sender 的消息
-
-                if not messages[recipient]:  # 如果 recipient 的消息都删光了，删除 recipient 记录
-                    del messages[recipient]
-
+        online_users.pop(username, None)
+        store.delete_user(username)
+        log_event("delete_account", username)
         print(f"❌ {username} has been deleted.")
 
 
+def log_event(*record):
+    """ append a state change to the log, called while holding the locks of the users it touches """
+    if message_log is None:
+        return
+    message_log.append(list(record))
+    if message_log.records >= snapshot_every:
+        snapshot_needed.set()
+
+def apply_record(record):
+    """ redo a logged state change, only used during recovery """
+    match record[0]:
+        case "account":
+            _, username, hashed = record
+            user_accounts[username] = hashed
+            store.save_account(username, hashed)
+        case "send":
+            store.add_message(record[1])
+        case "read":
+            _, sender, recipient = record
+            read_messages(sender, recipient)
+        case "delete":
+            _, username, msg_id = record
+            delete_message(username, msg_id)
+        case "delete_account":
+            delete_account(record[1])
+        case _:
+            raise ValueError(f"Unknown log record: {record[0]}")
+
+def recover(path):
+    """
+    rebuild the state from the snapshot and the log files in path,
+    return the generation the next log file should use
+    """
+    generation, state = persistence.read_snapshot(path)
+    if state is not None:
+        user_accounts.update(state["accounts"])
+        # nobody else is running yet, so no locks are needed
+        for msg in state["messages"]:
+            store.add_message(msg)
+
+    generations = [g for g in persistence.log_generations(path) if g >= generation]
+    for log_generation in generations:
+        for record in persistence.read_records(persistence.log_path(path, log_generation)):
+            apply_record(record)
+
+    # never append to a file that may end with a torn record
+    return max(generations + [generation - 1]) + 1
+
+def take_snapshot():
+    """ fold the current log into a new snapshot file """
+    with locked_all():
+        accounts = {username: hashed for username, hashed in user_accounts.items() if hashed is not None}
+        snapshot_messages = store.all_messages()
+        generation = message_log.rotate()
+    # records in the new log may already be reflected in the objects we
+    # captured (e.g. a message marked read), redoing them is harmless
+    persistence.write_snapshot(data_dir, generation, {"accounts": accounts, "messages": snapshot_messages})
+    message_log.remove_before(generation)
+    print(f"[INFO] Snapshot of {len(snapshot_messages)} messages taken, log generation {generation}")
+
+def snapshot_thread_entry(log):
+    while message_log is log:
+        if snapshot_needed.wait(timeout=1):
+            snapshot_needed.clear()
+            if message_log is log:
+                take_snapshot()
+
+def enable_persistence(path, snapshot_every_records=SNAPSHOT_EVERY, fsync=False):
+    """
+    recover the state stored in path and log every change from now on
+    """
+    global message_log, data_dir, snapshot_every
+    os.makedirs(path, exist_ok=True)
+    generation = recover(path)
+    data_dir = path
+    snapshot_every = snapshot_every_records
+    message_log = persistence.MessageLog(path, generation, fsync=fsync)
+    threading.Thread(target=snapshot_thread_entry, args=(message_log,), daemon=True).start()
+
+def disable_persistence():
+    global message_log, data_dir
+    if message_log is not None:
+        log = message_log
+        message_log = None
+        data_dir = None
+        log.close()
+
+
+def start_password_work(sock, username, pwd):
+    """
+    hash the password of a new account, or check it against the stored hash.
+    return a Future of the result, or None if the server is too busy to try
+    """
+    try:
+        # the behavior is creating account 
+        if user_accounts[username] is None:
+            return password_hasher.hash_pwd(pwd)
+        # the behavior is validating account
+        return password_hasher.check_pwd(pwd, user_accounts[username])
+    except PasswordPoolBusy:
+        send_data(sock, Protocol.RESP_SERVER_BUSY, None)
+        return None
+
+def finish_login(sock, address, username, result):
+    """ result is the new hash (account created) or whether the password matched """
+    if isinstance(result, str):
+        with locked(username):
+            user_accounts[username] = result
+            store.save_account(username, result)
+            log_event("account", username, result)
+    elif not result:
+        send_data(sock, Protocol.RESP_LOGIN_FAILED, None)
+        return
+    set_online(username, address, sock)
+    # a successful login should response the list of accounts
+    send_data(sock, Protocol.RESP_LOGIN_SUCCESS, list(user_accounts.keys()))
+
+async def handle_login_async(sock, address, pwd):
+    """ REQ_LOGIN_2 for the event loop, waits for the password work without blocking it """
+    username = connected_clients[address]
+    future = start_password_work(sock, username, pwd)
+    if future is not None:
+        finish_login(sock, address, username, await asyncio.wrap_future(future))
+
 def handle_request(sock, address, msg_type, parsed_obj):
     match msg_type:
         case Protocol.REQ_LOGIN_1:
             username = parsed_obj
+            # logging in again on this connection ends the previous session
+            if connected_clients.get(address) is not None:
+                set_offline(connected_clients[address], address)
             connected_clients[address] = username
+            with locked(username):
+                existing = username in user_accounts
+                if not existing:
+                    user_accounts[username] = None
             # user exists
-            if username in user_accounts:
+            if existing:
                 send_data(sock, Protocol.RESP_USER_EXISTING, None)
             # user not exists, prompt to create account
             else:
-                user_accounts[username] = None
                 send_data(sock, Protocol.RESP_USER_NOT_EXISTING, None)
             return
             
         case Protocol.REQ_LOGIN_2:
-            pwd = parsed_obj
             username = connected_clients[address]
-            # the behavior is creating account 
-            if user_accounts[username] is None:
-                user_accounts[username] = hash_pwd(pwd)
-                # a successful login should response the list of accounts
-                send_data(sock, Protocol.RESP_LOGIN_SUCCESS, list(user_accounts.keys()))
-            # the behavior is validating account
-            else:
-                if check_pwd(pwd, user_accounts[username]):
-                    send_data(sock, Protocol.RESP_LOGIN_SUCCESS, list(user_accounts.keys()))
-                else:
-                    send_data(sock, Protocol.RESP_LOGIN_FAILED, None)
+            future = start_password_work(sock, username, parsed_obj)
+            if future is not None:
+                finish_login(sock, address, username, future.result())
             return
                 
         case Protocol.REQ_SEND_MSG:
@@ -167,6 +381,31 @@ def handle_request(sock, address, msg_type, parsed_obj):
             send_data(sock, Protocol.RESP_LIST_MESSAGES, resp_list)
             return
 
+        case Protocol.REQ_LIST_MESSAGES_PAGE:
+            # {"friend": str, "before"/"after": timestamp or msg_id, "limit": int}
+            username = connected_clients[address]
+            try:
+                resp_list = list_messages_page(username, parsed_obj["friend"],
+                                               before=parsed_obj.get("before"),
+                                               after=parsed_obj.get("after"),
+                                               limit=parsed_obj.get("limit", DEFAULT_PAGE_SIZE))
+            except (KeyError, TypeError, ValueError) as e:
+                send_data(sock, Protocol.RESP_ERROR, str(e))
+                return
+            send_data(sock, Protocol.RESP_LIST_MESSAGES_PAGE, resp_list)
+            return
+
+        case Protocol.REQ_STREAM_MESSAGES:
+            username = connected_clients[address]
+            try:
+                friend, chunk_size = stream_request(parsed_obj)
+            except (AttributeError, KeyError, TypeError) as e:
+                send_data(sock, Protocol.RESP_ERROR, str(e))
+                return
+            chunks = Protocol.chunked(iter_conversation(username, friend, chunk_size), chunk_size)
+            send_stream(sock, Protocol.RESP_MESSAGES_CHUNK, Protocol.RESP_MESSAGES_END, chunks)
+            return
+
         case Protocol.REQ_LIST_USERS:
             username = connected_clients[address]
             resp_list = list_users(username)
@@ -193,15 +432,66 @@ def client_thread_entry(client_socket, address):
     """
     entry for each thread listening to a client
     """
+    client_socket = ThreadedConnection(client_socket)
+    reader = FrameReader(client_socket)
     handle_new_connection(address)
 
     try:
         while True:
-            msg_type, parsed_obj = recv_data(client_socket)
+            msg_type, parsed_obj = reader.read_frame()
             if msg_type is None:
                 break
-            handle_request(client_socket, address, msg_type, parsed_obj)
+            # answer every request that is already buffered, then send the replies together
+            client_socket.cork()
+            try:
+                handle_request(client_socket, address, msg_type, parsed_obj)
+                while reader.has_frame():
+                    msg_type, parsed_obj = reader.read_frame()
+                    handle_request(client_socket, address, msg_type, parsed_obj)
+            finally:
+                client_socket.uncork()
     except Exception as e:
         print(f"[ERROR] {e}")
     finally:
         handle_disconnect(client_socket, address)
+
+
+async def stream_messages_async(conn, address, parsed_obj):
+    """ REQ_STREAM_MESSAGES for the event loop, waits for each chunk to drain before the next """
+    username = connected_clients[address]
+    try:
+        friend, chunk_size = stream_request(parsed_obj)
+    except (AttributeError, KeyError, TypeError) as e:
+        send_data(conn, Protocol.RESP_ERROR, str(e))
+        return
+    count = 0
+    for chunk in Protocol.chunked(iter_conversation(username, friend, chunk_size), chunk_size):
+        send_data(conn, Protocol.RESP_MESSAGES_CHUNK, chunk)
+        count += len(chunk)
+        await conn.writer.drain()
+    send_data(conn, Protocol.RESP_MESSAGES_END, count)
+
+async def async_client_entry(reader, writer):
+    """
+    entry for each connection served by the asyncio event loop
+    """
+    address = writer.get_extra_info("peername")
+    conn = AsyncConnection(writer)
+    handle_new_connection(address)
+
+    try:
+        while True:
+            msg_type, parsed_obj = await recv_data_async(reader)
+            if msg_type is None:
+                break
+            if msg_type == Protocol.REQ_LOGIN_2:
+                await handle_login_async(conn, address, parsed_obj)
+            elif msg_type == Protocol.REQ_STREAM_MESSAGES:
+                await stream_messages_async(conn, address, parsed_obj)
+            else:
+                handle_request(conn, address, msg_type, parsed_obj)
+            await writer.drain()
+    except Exception as e:
+        print(f"[ERROR] {e}")
+    finally:
+        handle_disconnect(conn, address)
@@ -0,0 +1,112 @@
+import os
+import struct
+import threading
+from common.protocol import Protocol
+
+# files in the data directory:
+#   snapshot.bin          [generation, state] of the server, all logs before generation are folded in
+#   wal.<generation>.bin  records appended after that snapshot was taken
+SNAPSHOT_FILE = "snapshot.bin"
+LOG_PREFIX = "wal."
+LOG_SUFFIX = ".bin"
+
+# each log record is a uint32 length followed by a Protocol.encode_obj payload
+RECORD_HEADER = struct.Struct("!I")
+
+
+def log_path(data_dir, generation):
+    return os.path.join(data_dir, f"{LOG_PREFIX}{generation:08d}{LOG_SUFFIX}")
+
+def log_generations(data_dir):
+    """ generations of the log files in data_dir, oldest first """
+    generations = []
+    for name in os.listdir(data_dir):
+        if name.startswith(LOG_PREFIX) and name.endswith(LOG_SUFFIX):
+            generations.append(int(name[len(LOG_PREFIX):-len(LOG_SUFFIX)]))
+    return sorted(generations)
+
+def encode_record(record):
+    payload = Protocol.encode_obj(record)
+    return RECORD_HEADER.pack(len(payload)) + payload
+
+def read_records(path):
+    """
+    yield the records of a log file, a torn record at the end
+    (the server died in the middle of a write) is ignored
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    view = memoryview(data)
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        (length,) = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(data):
+            break
+        record, _ = Protocol.decode_obj(view[offset:offset + length], max_elements=None)
+        offset += length
+        yield record
+
+def write_snapshot(data_dir, generation, state):
+    """ write to a temporary file first, so a crash never leaves a half written snapshot """
+    path = os.path.join(data_dir, SNAPSHOT_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(Protocol.encode_obj([generation, state]))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_snapshot(data_dir):
+    """ return (generation, state), or (0, None) if no snapshot was taken yet """
+    path = os.path.join(data_dir, SNAPSHOT_FILE)
+    if not os.path.exists(path):
+        return 0, None
+    with open(path, "rb") as f:
+        data = f.read()
+    # our own file, a snapshot holds far more elements than any frame
+    (generation, state), _ = Protocol.decode_obj(data, max_elements=None)
+    return generation, state
+
+
+class MessageLog:
+    """
+    append-only log of the changes to the server state
+    """
+    def __init__(self, data_dir, generation, fsync=False):
+        self.data_dir = data_dir
+        self.generation = generation
+        self.fsync = fsync
+        # records appended since the last rotate
+        self.records = 0
+        self.lock = threading.Lock()
+        self.file = open(log_path(data_dir, generation), "ab")
+
+    def append(self, record):
+        data = encode_record(record)
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.records += 1
+
+    def rotate(self):
+        """ continue in a new log file, return its generation """
+        with self.lock:
+            self.file.close()
+            self.generation += 1
+            self.records = 0
+            self.file = open(log_path(self.data_dir, self.generation), "ab")
+            return self.generation
+
+    def remove_before(self, generation):
+        """ drop the log files already folded into a snapshot """
+        for old_generation in log_generations(self.data_dir):
+            if old_generation < generation:
+                os.remove(log_path(self.data_dir, old_generation))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
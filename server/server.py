@@ -1,21 +1,69 @@
+import argparse
+import asyncio
 import socket
 import threading
 import time
-from server.handler import client_thread_entry
+from server.handler import client_thread_entry, async_client_entry, enable_persistence, enable_password_pool, set_store, SNAPSHOT_EVERY
+from common.utils import BCRYPT_ROUNDS
+from server.storage import SqliteStore
 
 HOST = '127.0.0.1'
 PORT = 5000
+BACKLOG = 128
 
-def start_server():
+def start_server(host=HOST, port=PORT, backlog=BACKLOG):
+    """
+    thread-per-connection server
+    """
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((HOST, PORT))
-    server_socket.listen(5)
-    print(f"Server listening on {HOST}:{PORT}")
+    server_socket.bind((host, port))
+    server_socket.listen(backlog)
+    print(f"Server listening on {host}:{port}")
 
     while True:
         client_socket, addr = server_socket.accept()
         t = threading.Thread(target=client_thread_entry, args=(client_socket, addr))
         t.start()
 
+async def serve_async(host=HOST, port=PORT, backlog=BACKLOG):
+    server = await asyncio.start_server(async_client_entry, host, port, backlog=backlog)
+    print(f"Server (asyncio) listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def start_async_server(host=HOST, port=PORT, backlog=BACKLOG):
+    """
+    single event loop serving every connection, same wire format as start_server
+    """
+    asyncio.run(serve_async(host, port, backlog))
+
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--backlog", type=int, default=BACKLOG)
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread")
+    parser.add_argument("--store", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--db", default="chat.db", help="database file of the sqlite store")
+    parser.add_argument("--data-dir", help="keep a log and snapshots here, and recover from them on start (memory store)")
+    parser.add_argument("--snapshot-every", type=int, default=SNAPSHOT_EVERY, help="log records between snapshots")
+    parser.add_argument("--fsync", action="store_true", help="fsync the log after every record")
+    parser.add_argument("--password-workers", type=int, default=None,
+                        help="processes for bcrypt work (default: one per core, 0: run it in the connection's thread)")
+    parser.add_argument("--password-queue", type=int, default=64,
+                        help="password jobs queued at most, further logins get RESP_SERVER_BUSY")
+    parser.add_argument("--bcrypt-rounds", type=int, default=BCRYPT_ROUNDS, help="cost factor of new password hashes")
+    args = parser.parse_args()
+
+    enable_password_pool(args.password_workers, args.password_queue, args.bcrypt_rounds)
+    if args.store == "sqlite":
+        if args.data_dir:
+            parser.error("--data-dir is for the memory store, the sqlite store is durable on its own")
+        set_store(SqliteStore(args.db))
+    if args.data_dir:
+        enable_persistence(args.data_dir, args.snapshot_every, args.fsync)
+
+    if args.mode == "async":
+        start_async_server(args.host, args.port, args.backlog)
+    else:
+        start_server(args.host, args.port, args.backlog)
@@ -0,0 +1,388 @@
+from collections import deque, defaultdict
+import bisect
+import sqlite3
+import threading
+from common.message import Chatmsg
+
+
+def conversation_key(user1, user2):
+    """ unordered pair of users, so both directions share one conversation """
+    return (user1, user2) if user1 <= user2 else (user2, user1)
+
+
+class MessageStore:
+    """
+    interface of a storage backend for messages and accounts.
+    the handler serializes calls touching the same user with its shard locks,
+    so a backend only has to protect its own shared resources
+    """
+    def add_message(self, msg):
+        """ store msg as is, its status is already decided; storing the same id twice is a no-op """
+        raise NotImplementedError
+
+    def get_message(self, msg_id):
+        """ the message, or None """
+        raise NotImplementedError
+
+    def mark_read(self, sender, recipient):
+        """ mark every message from sender to recipient read, False if there are none """
+        raise NotImplementedError
+
+    def list_messages(self, user1, user2):
+        """ all messages between the two users, sorted by time """
+        raise NotImplementedError
+
+    def list_messages_page(self, user1, user2, before=None, after=None, limit=50):
+        """
+        at most limit messages between the two users, sorted by time:
+        - after: the oldest messages newer than the cursor
+        - before: the newest messages older than the cursor
+        - no cursor: the newest messages
+        a cursor is a timestamp or a message id, an unknown id raises ValueError
+        """
+        raise NotImplementedError
+
+    def count_unread(self, recipient):
+        """ {sender: number of unread messages}, senders without unread messages are left out """
+        raise NotImplementedError
+
+    def delete_message(self, sender, msg_id):
+        """ delete a message sent by sender, return it, or None if there is no such message """
+        raise NotImplementedError
+
+    def delete_user(self, username):
+        """ delete the account and every message the user sent or received """
+        raise NotImplementedError
+
+    def all_messages(self):
+        """ every stored message, used for snapshots """
+        raise NotImplementedError
+
+    def save_account(self, username, hashed):
+        raise NotImplementedError
+
+    def load_accounts(self):
+        """ {username: hashed password} of the accounts kept by the backend """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryStore(MessageStore):
+    """
+    dicts and deques in process memory, accounts live in handler.user_accounts
+    and durability comes from the handler's write-ahead log
+    """
+    def __init__(self):
+        self.message_store = {}  # {msg_id: Message}
+        self.messages = defaultdict(lambda: defaultdict(deque))  # {recipient: {sender: deque([msg_id1, msg_id2, ...])}}
+        self.conversations = defaultdict(list)  # {(user_a, user_b): [msg_id1, msg_id2, ...]} sorted by timestamp
+        self.unread_counts = {}  # {recipient: {sender: count}}, only non-zero counts are kept
+
+    def timestamp_of(self, msg_id):
+        return self.message_store[msg_id].timestamp
+
+    def decrement_unread(self, recipient, sender):
+        counts = self.unread_counts.get(recipient)
+        if counts is None or sender not in counts:
+            return
+        counts[sender] -= 1
+        if counts[sender] == 0:
+            del counts[sender]
+            if not counts:
+                del self.unread_counts[recipient]
+
+    def clear_unread(self, recipient, sender):
+        counts = self.unread_counts.get(recipient)
+        if counts is not None:
+            counts.pop(sender, None)
+            if not counts:
+                del self.unread_counts[recipient]
+
+    def add_message(self, msg):
+        if msg.id in self.message_store:
+            return
+        self.message_store[msg.id] = msg
+
+        self.messages[msg.recipient][msg.sender].append(msg.id)
+        # keep conversation ordered by time, normally this is an append
+        msg_ids = self.conversations[conversation_key(msg.sender, msg.recipient)]
+        if not msg_ids or self.timestamp_of(msg_ids[-1]) <= msg.timestamp:
+            msg_ids.append(msg.id)
+        else:
+            bisect.insort(msg_ids, msg.id, key=self.timestamp_of)
+
+        if msg.status == "unread":
+            counts = self.unread_counts.setdefault(msg.recipient, {})
+            counts[msg.sender] = counts.get(msg.sender, 0) + 1
+
+    def get_message(self, msg_id):
+        return self.message_store.get(msg_id)
+
+    def mark_read(self, sender, recipient):
+        if recipient not in self.messages or sender not in self.messages[recipient]:
+            return False
+
+        for msg_id in self.messages[recipient][sender]:
+            if msg_id in self.message_store:
+                self.message_store[msg_id].status = "read"
+
+        self.clear_unread(recipient, sender)
+        return True
+
+    def list_messages(self, user1, user2):
+        msg_ids = self.conversations.get(conversation_key(user1, user2), [])
+        return [self.message_store[msg_id] for msg_id in msg_ids]
+
+    def cursor_index(self, msg_ids, cursor, after):
+        """
+        position of a cursor in a conversation.
+        messages from this position on are newer than the cursor (after=True),
+        messages before it are older than the cursor (after=False)
+        """
+        if isinstance(cursor, str):
+            if cursor not in self.message_store:
+                raise ValueError(f"Unknown message id: {cursor}")
+            index = bisect.bisect_left(msg_ids, self.timestamp_of(cursor), key=self.timestamp_of)
+            while index < len(msg_ids) and msg_ids[index] != cursor:
+                index += 1
+            if index == len(msg_ids):
+                raise ValueError(f"Message {cursor} is not in this conversation")
+            return index + 1 if after else index
+        if after:
+            return bisect.bisect_right(msg_ids, cursor, key=self.timestamp_of)
+        return bisect.bisect_left(msg_ids, cursor, key=self.timestamp_of)
+
+    def list_messages_page(self, user1, user2, before=None, after=None, limit=50):
+        msg_ids = self.conversations.get(conversation_key(user1, user2), [])
+        if after is not None:
+            start = self.cursor_index(msg_ids, after, after=True)
+            end = start + limit
+        else:
+            end = len(msg_ids) if before is None else self.cursor_index(msg_ids, before, after=False)
+            start = max(0, end - limit)
+        return [self.message_store[msg_id] for msg_id in msg_ids[start:end]]
+
+    def count_unread(self, recipient):
+        return dict(self.unread_counts.get(recipient, {}))
+
+    def delete_message(self, sender, msg_id):
+        msg = self.message_store.get(msg_id)
+        if msg is None or msg.sender != sender:
+            return None
+        recipient = msg.recipient
+        if msg.status == "unread":
+            self.decrement_unread(recipient, sender)
+        del self.message_store[msg_id]
+
+        self.messages[recipient][sender].remove(msg_id)
+        key = conversation_key(sender, recipient)
+        self.conversations[key].remove(msg_id)
+        if not self.conversations[key]:
+            del self.conversations[key]
+        return msg
+
+    def delete_user(self, username):
+        messages = self.messages
+        self.unread_counts.pop(username, None)
+        if username in messages:
+            for sender in list(messages[username].keys()):  # iterate message this user received
+                for msg_id in messages[username][sender]:
+                    if msg_id in self.message_store:
+                        del self.message_store[msg_id]
+                self.conversations.pop(conversation_key(username, sender), None)
+            del messages[username]
+
+        for recipient in list(messages.keys()):  # iterate message this user sended
+            if username in messages[recipient]:  # if user is sender
+                for msg_id in messages[recipient][username]:
+                    if msg_id in self.message_store:
+                        del self.message_store[msg_id]
+                self.conversations.pop(conversation_key(username, recipient), None)
+                self.clear_unread(recipient, username)
+                del messages[recipient][username]
+
+                if not messages[recipient]:  # nothing left for this recipient
+                    del messages[recipient]
+
+    def all_messages(self):
+        return list(self.message_store.values())
+
+    def save_account(self, username, hashed):
+        pass
+
+    def load_accounts(self):
+        return {}
+
+
+class SqliteStore(MessageStore):
+    """
+    messages and accounts in a SQLite database, so history can exceed RAM.
+    writes are committed in batches: every batch_size writes, or by a
+    background thread every commit_interval seconds
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS messages (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id TEXT NOT NULL UNIQUE,
+        sender TEXT NOT NULL,
+        recipient TEXT NOT NULL,
+        user_a TEXT NOT NULL,
+        user_b TEXT NOT NULL,
+        content TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        status TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_conversation ON messages (user_a, user_b, timestamp, seq);
+    CREATE INDEX IF NOT EXISTS idx_recipient ON messages (recipient, status, sender);
+    CREATE INDEX IF NOT EXISTS idx_sender ON messages (sender);
+    CREATE TABLE IF NOT EXISTS accounts (
+        username TEXT PRIMARY KEY,
+        hashed TEXT NOT NULL
+    );
+    """
+    COLUMNS = "id, sender, recipient, content, timestamp, status"
+
+    def __init__(self, path, batch_size=1000, commit_interval=0.05):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+        # one connection shared by every handler thread
+        self.lock = threading.Lock()
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.pending = 0
+        self.closed = threading.Event()
+        threading.Thread(target=self.commit_thread_entry, daemon=True).start()
+
+    @staticmethod
+    def row_to_msg(row):
+        msg_id, sender, recipient, content, timestamp, status = row
+        return Chatmsg(sender, recipient, content, msg_id=msg_id, timestamp=timestamp, status=status)
+
+    def write(self, sql, params=()):
+        """ run a statement, caller holds self.lock """
+        cursor = self.conn.execute(sql, params)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+        return cursor
+
+    def commit(self):
+        """ caller holds self.lock """
+        if self.pending:
+            self.conn.commit()
+            self.pending = 0
+
+    def commit_thread_entry(self):
+        while not self.closed.wait(self.commit_interval):
+            with self.lock:
+                self.commit()
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def add_message(self, msg):
+        user_a, user_b = conversation_key(msg.sender, msg.recipient)
+        with self.lock:
+            self.write(
+                "INSERT OR IGNORE INTO messages (id, sender, recipient, user_a, user_b, content, timestamp, status) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (msg.id, msg.sender, msg.recipient, user_a, user_b, msg.content, msg.timestamp, msg.status))
+
+    def get_message(self, msg_id):
+        rows = self.query(f"SELECT {self.COLUMNS} FROM messages WHERE id = ?", (msg_id,))
+        return self.row_to_msg(rows[0]) if rows else None
+
+    def mark_read(self, sender, recipient):
+        with self.lock:
+            exists = self.conn.execute(
+                "SELECT 1 FROM messages WHERE recipient = ? AND sender = ? LIMIT 1", (recipient, sender)).fetchone()
+            if exists is None:
+                return False
+            self.write("UPDATE messages SET status = 'read' WHERE recipient = ? AND status = 'unread' AND sender = ?",
+                       (recipient, sender))
+            return True
+
+    def list_messages(self, user1, user2):
+        rows = self.query(
+            f"SELECT {self.COLUMNS} FROM messages WHERE user_a = ? AND user_b = ? ORDER BY timestamp, seq",
+            conversation_key(user1, user2))
+        return [self.row_to_msg(row) for row in rows]
+
+    def cursor_position(self, user_a, user_b, cursor):
+        """ (timestamp, seq) of a message id cursor, caller holds self.lock """
+        row = self.conn.execute("SELECT timestamp, seq, user_a, user_b FROM messages WHERE id = ?", (cursor,)).fetchone()
+        if row is None:
+            raise ValueError(f"Unknown message id: {cursor}")
+        if (row[2], row[3]) != (user_a, user_b):
+            raise ValueError(f"Message {cursor} is not in this conversation")
+        return row[0], row[1]
+
+    def list_messages_page(self, user1, user2, before=None, after=None, limit=50):
+        user_a, user_b = conversation_key(user1, user2)
+        select = f"SELECT {self.COLUMNS} FROM messages WHERE user_a = ? AND user_b = ?"
+        with self.lock:
+            if after is not None:
+                if isinstance(after, str):
+                    timestamp, seq = self.cursor_position(user_a, user_b, after)
+                    sql = select + " AND (timestamp, seq) > (?, ?) ORDER BY timestamp, seq LIMIT ?"
+                    params = (user_a, user_b, timestamp, seq, limit)
+                else:
+                    sql = select + " AND timestamp > ? ORDER BY timestamp, seq LIMIT ?"
+                    params = (user_a, user_b, after, limit)
+                rows = self.conn.execute(sql, params).fetchall()
+            else:
+                if before is None:
+                    sql = select + " ORDER BY timestamp DESC, seq DESC LIMIT ?"
+                    params = (user_a, user_b, limit)
+                elif isinstance(before, str):
+                    timestamp, seq = self.cursor_position(user_a, user_b, before)
+                    sql = select + " AND (timestamp, seq) < (?, ?) ORDER BY timestamp DESC, seq DESC LIMIT ?"
+                    params = (user_a, user_b, timestamp, seq, limit)
+                else:
+                    sql = select + " AND timestamp < ? ORDER BY timestamp DESC, seq DESC LIMIT ?"
+                    params = (user_a, user_b, before, limit)
+                rows = self.conn.execute(sql, params).fetchall()
+                rows.reverse()
+        return [self.row_to_msg(row) for row in rows]
+
+    def count_unread(self, recipient):
+        rows = self.query(
+            "SELECT sender, COUNT(*) FROM messages WHERE recipient = ? AND status = 'unread' GROUP BY sender",
+            (recipient,))
+        return dict(rows)
+
+    def delete_message(self, sender, msg_id):
+        msg = self.get_message(msg_id)
+        if msg is None or msg.sender != sender:
+            return None
+        with self.lock:
+            self.write("DELETE FROM messages WHERE id = ?", (msg_id,))
+        return msg
+
+    def delete_user(self, username):
+        with self.lock:
+            self.write("DELETE FROM messages WHERE sender = ? OR recipient = ?", (username, username))
+            self.write("DELETE FROM accounts WHERE username = ?", (username,))
+
+    def all_messages(self):
+        rows = self.query(f"SELECT {self.COLUMNS} FROM messages ORDER BY seq")
+        return [self.row_to_msg(row) for row in rows]
+
+    def save_account(self, username, hashed):
+        with self.lock:
+            self.write("INSERT OR REPLACE INTO accounts (username, hashed) VALUES (?, ?)", (username, hashed))
+
+    def load_accounts(self):
+        return dict(self.query("SELECT username, hashed FROM accounts"))
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            self.commit()
+            self.conn.close()
@@ -0,0 +1,24 @@
+import time
+import pytest
+from server.auth import PasswordPool, PasswordPoolBusy, InlinePasswordHasher
+
+
+def test_inline_hasher():
+    hasher = InlinePasswordHasher(rounds=4)
+    hashed = hasher.hash_pwd("password").result()
+    assert hasher.check_pwd("password", hashed).result()
+    assert not hasher.check_pwd("wrong", hashed).result()
+
+def test_password_pool():
+    pool = PasswordPool(workers=2, max_pending=1, rounds=4)
+    try:
+        future = pool.hash_pwd("password")
+        # the only slot is taken until the first job finishes
+        with pytest.raises(PasswordPoolBusy):
+            pool.check_pwd("password", "not a hash yet")
+        hashed = future.result()
+        time.sleep(0.1)  # the slot is released by a callback right after the result is set
+        assert hashed.startswith("$2b$04$")
+        assert pool.check_pwd("password", hashed).result()
+    finally:
+        pool.shutdown()
@@ -0,0 +1,49 @@
+import socket
+import threading
+import pytest
+from common.utils import FrameReader, send_data
+from common.protocol import Protocol
+from server.connection import ThreadedConnection
+
+
+@pytest.fixture
+def sock_pair():
+    left, right = socket.socketpair()
+    yield left, right
+    left.close()
+    right.close()
+
+
+def test_corked_frames_are_sent_together(sock_pair, monkeypatch):
+    left, right = sock_pair
+    conn = ThreadedConnection(left)
+    calls = []
+    monkeypatch.setattr("server.connection.send_segments",
+                        lambda sock, segments: calls.append(len(segments)) or sock.sendall(b"".join(segments)))
+
+    conn.cork()
+    for i in range(3):
+        send_data(conn, Protocol.RESP_LIST_USERS, {"user": i})
+    assert calls == []
+    conn.uncork()
+    # one write for the three frames
+    assert calls == [3]
+
+    reader = FrameReader(right)
+    for i in range(3):
+        assert reader.read_frame() == (Protocol.RESP_LIST_USERS, {"user": i})
+
+def test_send_segments_large(sock_pair):
+    left, right = sock_pair
+    conn = ThreadedConnection(left)
+    # more segments than one sendmsg takes, and more bytes than the socket buffer
+    conn.cork()
+    for i in range(2000):
+        send_data(conn, Protocol.RESP_LIST_USERS, {"user": "x" * 100 + str(i)})
+
+    t = threading.Thread(target=conn.uncork)
+    t.start()
+    reader = FrameReader(right)
+    for i in range(2000):
+        assert reader.read_frame() == (Protocol.RESP_LIST_USERS, {"user": "x" * 100 + str(i)})
+    t.join()
@@ -0,0 +1,121 @@
+import threading
+import pytest
+from server import handler
+
+
+@pytest.fixture
+def users():
+    """two users whose messages are removed again after the test"""
+    yield "dave", "erin"
+    handler.delete_account("dave")
+    handler.delete_account("erin")
+
+
+def test_list_messages_only_conversation(users):
+    dave, erin = users
+    handler.send_message(dave, erin, "one")
+    handler.send_message(erin, dave, "two")
+    handler.send_message(dave, "someone_else", "not in this chat")
+
+    resp = handler.list_messages(dave, erin)
+    assert [msg.content for msg in resp] == ["one", "two"]
+    # both sides see the same conversation
+    assert handler.list_messages(erin, dave) == resp
+    handler.delete_account("someone_else")
+
+def test_list_messages_sorted_by_time(users, monkeypatch):
+    dave, erin = users
+    # the clock steps backwards between the two sends
+    clock = iter([200.0, 100.0])
+    monkeypatch.setattr("common.message.time.time", lambda: next(clock))
+    handler.send_message(dave, erin, "later")
+    handler.send_message(erin, dave, "earlier")
+
+    resp = handler.list_messages(dave, erin)
+    assert [msg.content for msg in resp] == ["earlier", "later"]
+
+def test_delete_message_updates_conversation(users):
+    dave, erin = users
+    handler.send_message(dave, erin, "keep")
+    handler.send_message(dave, erin, "drop")
+    drop = handler.list_messages(dave, erin)[1]
+
+    handler.delete_message(dave, drop.id)
+    assert [msg.content for msg in handler.list_messages(dave, erin)] == ["keep"]
+
+def test_unread_counters(users):
+    dave, erin = users
+    handler.user_accounts[dave] = None
+    handler.user_accounts[erin] = None
+    handler.send_message(dave, erin, "one")
+    handler.send_message(dave, erin, "two")
+    handler.send_message(dave, erin, "three")
+    assert handler.list_users(erin)[dave] == 3
+    assert handler.list_users(dave)[erin] == 0
+
+    # deleting an unread message lowers the count
+    handler.delete_message(dave, handler.list_messages(dave, erin)[0].id)
+    assert handler.list_users(erin)[dave] == 2
+
+    handler.read_messages(sender=dave, recipient=erin)
+    assert handler.list_users(erin)[dave] == 0
+    assert erin not in handler.store.unread_counts
+
+    # looking up counts does not create entries
+    handler.list_users("nobody")
+    assert "nobody" not in handler.store.unread_counts
+    assert "nobody" not in handler.store.messages
+
+def test_delete_account_clears_unread(users):
+    dave, erin = users
+    handler.send_message(dave, erin, "hi")
+    handler.send_message(erin, dave, "hello")
+    handler.delete_account(dave)
+    assert dave not in handler.store.unread_counts
+    assert dave not in handler.store.unread_counts.get(erin, {})
+
+def test_list_messages_page(users):
+    dave, erin = users
+    for i in range(10):
+        handler.send_message(dave, erin, str(i))
+    all_msgs = handler.list_messages(dave, erin)
+
+    # newest page by default
+    page = handler.list_messages_page(dave, erin, limit=3)
+    assert [msg.content for msg in page] == ["7", "8", "9"]
+    # walk backwards with a message id cursor
+    page = handler.list_messages_page(dave, erin, before=page[0].id, limit=3)
+    assert [msg.content for msg in page] == ["4", "5", "6"]
+    # walk forwards with a message id cursor
+    page = handler.list_messages_page(erin, dave, after=all_msgs[1].id, limit=2)
+    assert [msg.content for msg in page] == ["2", "3"]
+    # timestamp cursors
+    page = handler.list_messages_page(dave, erin, after=all_msgs[8].timestamp)
+    assert [msg.content for msg in page] == ["9"]
+    page = handler.list_messages_page(dave, erin, before=all_msgs[2].timestamp)
+    assert [msg.content for msg in page] == ["0", "1"]
+
+    with pytest.raises(ValueError):
+        handler.list_messages_page(dave, erin, before="no such id")
+
+def test_concurrent_sends(users):
+    dave, erin = users
+    senders = [f"sender_{i}" for i in range(8)]
+
+    def send_many(sender):
+        for i in range(100):
+            handler.send_message(sender, erin, str(i))
+            handler.send_message(dave, sender, str(i))
+
+    threads = [threading.Thread(target=send_many, args=(sender,)) for sender in senders]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for sender in senders:
+        assert len(handler.list_messages(sender, erin)) == 100
+        assert handler.store.unread_counts[erin][sender] == 100
+        assert handler.store.unread_counts[sender][dave] == 100
+    for sender in senders:
+        handler.delete_account(sender)
@@ -0,0 +1,64 @@
+import pytest
+from server import handler, persistence
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """persistence enabled in a temp dir, state and log are dropped after the test"""
+    handler.enable_persistence(str(tmp_path))
+    yield str(tmp_path)
+    handler.disable_persistence()
+    for username in ["lisa", "mike"]:
+        handler.delete_account(username)
+
+
+def restart(path):
+    """forget the in-memory state, then recover it from disk"""
+    handler.disable_persistence()
+    for username in ["lisa", "mike"]:
+        handler.delete_account(username)
+    assert handler.list_messages("lisa", "mike") == []
+    handler.enable_persistence(path)
+
+
+def test_read_records_ignores_torn_record(tmp_path):
+    path = str(tmp_path / "wal.bin")
+    with open(path, "wb") as f:
+        f.write(persistence.encode_record(["read", "lisa", "mike"]))
+        f.write(persistence.encode_record(["delete_account", "lisa"])[:-3])
+    assert list(persistence.read_records(path)) == [["read", "lisa", "mike"]]
+
+def test_recover_from_log(data_dir):
+    handler.user_accounts["lisa"] = "hash"
+    handler.log_event("account", "lisa", "hash")
+    handler.send_message("lisa", "mike", "one")
+    handler.send_message("lisa", "mike", "two")
+    handler.send_message("mike", "lisa", "three")
+    handler.delete_message("lisa", handler.list_messages("lisa", "mike")[0].id)
+    handler.read_messages(sender="mike", recipient="lisa")
+    expected = handler.list_messages("lisa", "mike")
+
+    restart(data_dir)
+    assert handler.user_accounts["lisa"] == "hash"
+    recovered = handler.list_messages("lisa", "mike")
+    assert recovered == expected
+    assert [msg.id for msg in recovered] == [msg.id for msg in expected]
+    assert handler.store.unread_counts["mike"] == {"lisa": 1}
+    assert "lisa" not in handler.store.unread_counts
+
+def test_recover_from_snapshot_and_log(data_dir):
+    handler.send_message("lisa", "mike", "before snapshot")
+    handler.take_snapshot()
+    # the old log file was folded into the snapshot
+    assert persistence.log_generations(data_dir) == [handler.message_log.generation]
+    handler.send_message("lisa", "mike", "after snapshot")
+
+    restart(data_dir)
+    recovered = handler.list_messages("lisa", "mike")
+    assert [msg.content for msg in recovered] == ["before snapshot", "after snapshot"]
+    assert handler.store.unread_counts["mike"] == {"lisa": 2}
+
+    # new changes go to a fresh log file
+    handler.send_message("mike", "lisa", "after restart")
+    restart(data_dir)
+    assert len(handler.list_messages("lisa", "mike")) == 3
@@ -1,5 +1,5 @@
 import pytest
-from common.protocol import Protocol
+from common.protocol import Protocol, ProtocolError
 from common.message import Chatmsg
 
 
@@ -52,3 +52,73 @@ def test_chat_msg(protocol):
     assert decoded_data.recipient == "bob"
     assert decoded_data.content == "test"
 
+def test_chat_msg_all_fields(protocol):
+    data = Chatmsg("eric", "bób", "tést 🙂", timestamp=12.5, status="read")
+    decoded_data, _ = protocol.decode_obj(protocol.encode_obj(data))
+    assert decoded_data.to_dict() == data.to_dict()
+
+def test_chat_msg_list(protocol):
+    data = [Chatmsg("eric", "bob", f"message {i}") for i in range(3)]
+    encoded_data = protocol.encode_obj(data)
+    # packed list of records
+    assert encoded_data[0] == 0x07
+    decoded_data, _ = protocol.decode_obj(encoded_data)
+    assert [msg.to_dict() for msg in decoded_data] == [msg.to_dict() for msg in data]
+
+def test_chat_msg_fallback(protocol):
+    # a status the fixed layout has no code for
+    data = Chatmsg("eric", "bob", "test", status="delivered")
+    encoded_data = protocol.encode_obj(data)
+    assert encoded_data[0] == 0x05
+    decoded_data, _ = protocol.decode_obj(encoded_data)
+    assert decoded_data.status == "delivered"
+
+    # the whole list falls back when one message doesn't fit
+    encoded_data = protocol.encode_obj([Chatmsg("eric", "bob", "ok"), data])
+    assert encoded_data[0] == 0x03
+    decoded_data, _ = protocol.decode_obj(encoded_data)
+    assert [msg.status for msg in decoded_data] == ["unread", "delivered"]
+
+def test_nested(protocol):
+    data = {"a": [1, [2.5, {"b": []}], {}], "c": Chatmsg("eric", "bob", "test")}
+    decoded_data, offset = protocol.decode_obj(protocol.encode_obj(data))
+    assert decoded_data == data
+    assert offset == len(protocol.encode_obj(data))
+
+def test_generic_chat_msg(protocol):
+    # dictionary form, type 0x05, as written by older versions
+    data = Chatmsg("eric", "bob", "test")
+    encoded_data = b'\x05' + protocol.encode_obj(data.to_dict())
+    decoded_data, _ = protocol.decode_obj(encoded_data)
+    assert decoded_data.to_dict() == data.to_dict()
+
+def test_decode_limits(protocol):
+    deep = []
+    for _ in range(40):
+        deep = [deep]
+    with pytest.raises(ProtocolError):
+        protocol.decode_obj(protocol.encode_obj(deep))
+    assert protocol.decode_obj(protocol.encode_obj(deep), max_depth=50)[0] == deep
+
+    with pytest.raises(ProtocolError):
+        protocol.decode_obj(protocol.encode_obj(list(range(100))), max_elements=10)
+
+def test_decode_malformed(protocol):
+    # a list claiming 4 billion items in a few bytes is refused up front
+    with pytest.raises(ProtocolError):
+        protocol.decode_obj(b'\x03\xff\xff\xff\xff\x00')
+    with pytest.raises(ProtocolError):
+        protocol.decode_obj(b'\x07\xff\xff\xff\xff')
+    # truncated data
+    encoded_data = protocol.encode_obj({"apple": "banana"})
+    with pytest.raises(ProtocolError):
+        protocol.decode_obj(encoded_data[:-2])
+    encoded_data = protocol.encode_obj(Chatmsg("eric", "bob", "test"))
+    with pytest.raises(ProtocolError):
+        protocol.decode_obj(encoded_data[:-2])
+    with pytest.raises(ProtocolError):
+        protocol.decode_obj(b'\x09')
+    # still a ValueError for existing callers
+    with pytest.raises(ValueError):
+        protocol.decode_obj(b'\x04\x00\x00\x00\x01\x00' + b'\x00' * 16)
+
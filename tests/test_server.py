@@ -2,8 +2,9 @@ import socket
 import threading
 import time
 import pytest
-from server.server import start_server, HOST, PORT 
-from server.handler import user_accounts, connected_clients
+from server.server import start_server, start_async_server, HOST, PORT 
+from server import handler
+from server.handler import user_accounts, connected_clients, online_users
 from common.utils import send_data, recv_data
 from common.message import Chatmsg
 from common.protocol import Protocol
@@ -18,6 +19,17 @@ def server():
     yield
 
 
+ASYNC_PORT = PORT + 1
+
+@pytest.fixture(scope="session")
+def async_server():
+    """start asyncio server in its own thread"""
+    server_thread = threading.Thread(target=start_async_server, args=(HOST, ASYNC_PORT), daemon=True)
+    server_thread.start()
+    time.sleep(1)
+    yield
+
+
 def test_login(server):  
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client_socket.connect((HOST, PORT))
@@ -107,6 +119,7 @@ def test_send_read_list_msg(server):
     assert resp == {"eric":2, "test_user" :0, "bob" :0}
     # bob read unread-message from eric
     send_data(client_socket_bob, Protocol.REQ_READ_MSG, "eric")
+    time.sleep(0.2)  # bob's request is handled on another connection
     # eric request msg list 
     send_data(client_socket, Protocol.REQ_LIST_MESSAGES, "bob")
     resp_type, resp = recv_data(client_socket)
@@ -131,6 +144,7 @@ def test_send_read_list_msg(server):
 
     # bob delete his account
     send_data(client_socket_bob, Protocol.REQ_DELETE_ACCOUNT, None)
+    time.sleep(0.2)
     send_data(client_socket, Protocol.REQ_LIST_MESSAGES, "bob")
     resp_type, resp = recv_data(client_socket)
     # there should be no message left 
@@ -143,4 +157,118 @@ def test_send_read_list_msg(server):
     client_socket_bob.close()
 
 
+def test_async_server(async_server):
+    # login as alice
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.connect((HOST, ASYNC_PORT))
+    send_data(client_socket, Protocol.REQ_LOGIN_1, "alice")
+    resp_type, resp = recv_data(client_socket)
+    assert resp_type == Protocol.RESP_USER_NOT_EXISTING
+    send_data(client_socket, Protocol.REQ_LOGIN_2, "password")
+    resp_type, resp = recv_data(client_socket)
+    assert resp_type == Protocol.RESP_LOGIN_SUCCESS
+
+    # alice send carol a message and list the conversation
+    send_data(client_socket, Protocol.REQ_SEND_MSG, ["carol", "hi carol"])
+    send_data(client_socket, Protocol.REQ_LIST_MESSAGES, "carol")
+    resp_type, resp = recv_data(client_socket)
+    assert resp_type == Protocol.RESP_LIST_MESSAGES
+    assert resp == [Chatmsg(sender="alice", recipient="carol", content="hi carol", status="unread")]
+
+    client_socket.close()
+
+def test_list_messages_page(server):
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.connect((HOST, PORT))
+    send_data(client_socket, Protocol.REQ_LOGIN_1, "frank")
+    resp_type, resp = recv_data(client_socket)
+    send_data(client_socket, Protocol.REQ_LOGIN_2, "password")
+    resp_type, resp = recv_data(client_socket)
+
+    for content in ["a", "b", "c"]:
+        send_data(client_socket, Protocol.REQ_SEND_MSG, ["grace", content])
+    # newest two messages
+    send_data(client_socket, Protocol.REQ_LIST_MESSAGES_PAGE, {"friend": "grace", "limit": 2})
+    resp_type, resp = recv_data(client_socket)
+    assert resp_type == Protocol.RESP_LIST_MESSAGES_PAGE
+    assert [msg.content for msg in resp] == ["b", "c"]
+    # the page before them
+    send_data(client_socket, Protocol.REQ_LIST_MESSAGES_PAGE, {"friend": "grace", "before": resp[0].id, "limit": 2})
+    resp_type, resp = recv_data(client_socket)
+    assert [msg.content for msg in resp] == ["a"]
+    # bad cursor
+    send_data(client_socket, Protocol.REQ_LIST_MESSAGES_PAGE, {"friend": "grace", "after": "no such id"})
+    resp_type, resp = recv_data(client_socket)
+    assert resp_type == Protocol.RESP_ERROR
+
+    client_socket.close()
+
+def test_push_message(server):
+    # hank and ivy are both online
+    sockets = {}
+    for name in ["hank", "ivy"]:
+        sockets[name] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sockets[name].connect((HOST, PORT))
+        send_data(sockets[name], Protocol.REQ_LOGIN_1, name)
+        recv_data(sockets[name])
+        send_data(sockets[name], Protocol.REQ_LOGIN_2, "password")
+        recv_data(sockets[name])
+
+    send_data(sockets["hank"], Protocol.REQ_SEND_MSG, ["ivy", "pushed"])
+    # ivy gets the message without asking for it
+    resp_type, resp = recv_data(sockets["ivy"])
+    assert resp_type == Protocol.RESP_PUSH_MESSAGE
+    assert resp == Chatmsg(sender="hank", recipient="ivy", content="pushed", status="read")
+
+    for sock in sockets.values():
+        sock.close()
+
+def test_presence_multiple_sessions(server):
+    def connect(name, password=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((HOST, PORT))
+        send_data(sock, Protocol.REQ_LOGIN_1, name)
+        recv_data(sock)
+        if password is not None:
+            send_data(sock, Protocol.REQ_LOGIN_2, password)
+            recv_data(sock)
+        return sock
+
+    ken = connect("ken", "password")
+    judy_1 = connect("judy", "password")
+    judy_2 = connect("judy", "password")
+    # entered the username only, not logged in yet
+    judy_3 = connect("judy")
+    assert len(online_users["judy"]) == 2
+
+    # every logged in session of judy gets the message
+    send_data(ken, Protocol.REQ_SEND_MSG, ["judy", "hi judy"])
+    for sock in [judy_1, judy_2]:
+        resp_type, resp = recv_data(sock)
+        assert resp_type == Protocol.RESP_PUSH_MESSAGE
+        assert resp.content == "hi judy"
+
+    for sock in [judy_1, judy_2, judy_3]:
+        sock.close()
+    time.sleep(0.5)
+    assert "judy" not in online_users
+    ken.close()
+
+def test_login_with_password_pool(async_server):
+    handler.enable_password_pool(workers=2, rounds=4)
+    try:
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.connect((HOST, ASYNC_PORT))
+        send_data(client_socket, Protocol.REQ_LOGIN_1, "nina")
+        resp_type, resp = recv_data(client_socket)
+        send_data(client_socket, Protocol.REQ_LOGIN_2, "password")
+        resp_type, resp = recv_data(client_socket)
+        assert resp_type == Protocol.RESP_LOGIN_SUCCESS
+        assert user_accounts["nina"].startswith("$2b$04$")
 
+        send_data(client_socket, Protocol.REQ_LOGIN_2, "fake password")
+        resp_type, resp = recv_data(client_socket)
+        assert resp_type == Protocol.RESP_LOGIN_FAILED
+        client_socket.close()
+    finally:
+        handler.enable_password_pool(workers=0)
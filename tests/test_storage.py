@@ -0,0 +1,82 @@
+import pytest
+from server.storage import MemoryStore, SqliteStore
+from common.message import Chatmsg
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        store = MemoryStore()
+    else:
+        store = SqliteStore(str(tmp_path / "chat.db"))
+    yield store
+    store.close()
+
+
+def add(store, sender, recipient, content, timestamp, status="unread"):
+    msg = Chatmsg(sender, recipient, content, timestamp=timestamp, status=status)
+    store.add_message(msg)
+    return msg
+
+def test_list_and_page(store):
+    msgs = [add(store, "a", "b", str(i), float(i)) if i % 2 else add(store, "b", "a", str(i), float(i))
+            for i in range(1, 8)]
+    add(store, "a", "c", "other chat", 4.5)
+
+    assert [msg.content for msg in store.list_messages("b", "a")] == ["1", "2", "3", "4", "5", "6", "7"]
+    page = store.list_messages_page("a", "b", limit=3)
+    assert [msg.content for msg in page] == ["5", "6", "7"]
+    page = store.list_messages_page("a", "b", before=page[0].id, limit=3)
+    assert [msg.content for msg in page] == ["2", "3", "4"]
+    page = store.list_messages_page("a", "b", after=msgs[4].id, limit=10)
+    assert [msg.content for msg in page] == ["6", "7"]
+    page = store.list_messages_page("a", "b", after=2.0, limit=2)
+    assert [msg.content for msg in page] == ["3", "4"]
+    page = store.list_messages_page("a", "b", before=2.0)
+    assert [msg.content for msg in page] == ["1"]
+    with pytest.raises(ValueError):
+        store.list_messages_page("a", "b", after="no such id")
+
+def test_unread_and_mark_read(store):
+    add(store, "a", "b", "1", 1.0)
+    add(store, "a", "b", "2", 2.0)
+    add(store, "c", "b", "3", 3.0)
+    add(store, "c", "b", "4", 4.0, status="read")
+    assert store.count_unread("b") == {"a": 2, "c": 1}
+
+    assert store.mark_read("a", "b")
+    assert store.count_unread("b") == {"c": 1}
+    assert [msg.status for msg in store.list_messages("a", "b")] == ["read", "read"]
+    assert not store.mark_read("x", "b")
+
+def test_delete(store):
+    keep = add(store, "a", "b", "keep", 1.0)
+    drop = add(store, "a", "b", "drop", 2.0)
+    add(store, "c", "a", "from c", 3.0)
+
+    # only the sender can delete a message
+    assert store.delete_message("b", drop.id) is None
+    assert store.delete_message("a", drop.id) == drop
+    assert store.get_message(drop.id) is None
+    assert store.list_messages("a", "b") == [keep]
+    assert store.count_unread("b") == {"a": 1}
+
+    store.save_account("a", "hash")
+    store.delete_user("a")
+    assert store.list_messages("a", "b") == []
+    assert store.list_messages("a", "c") == []
+    assert store.count_unread("b") == {}
+    assert store.all_messages() == []
+    assert "a" not in store.load_accounts()
+
+def test_sqlite_keeps_data(tmp_path):
+    path = str(tmp_path / "chat.db")
+    store = SqliteStore(path)
+    msg = add(store, "a", "b", "hi", 1.0)
+    store.save_account("a", "hash")
+    store.close()
+
+    store = SqliteStore(path)
+    assert store.list_messages("a", "b") == [msg]
+    assert store.load_accounts() == {"a": "hash"}
+    store.close()
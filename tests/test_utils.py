@@ -0,0 +1,75 @@
+import socket
+import threading
+import pytest
+from common.utils import FrameReader, send_data, recv_data
+from common.protocol import Protocol, ProtocolError
+
+
+@pytest.fixture
+def sock_pair():
+    left, right = socket.socketpair()
+    yield left, right
+    left.close()
+    right.close()
+
+
+def test_pipelined_frames(sock_pair):
+    left, right = sock_pair
+    # several frames arrive with one read
+    for i in range(5):
+        send_data(left, Protocol.REQ_SEND_MSG, ["bob", f"hey {i}"])
+    send_data(left, Protocol.REQ_LIST_USERS, None)
+
+    reader = FrameReader(right)
+    for i in range(5):
+        assert reader.read_frame() == (Protocol.REQ_SEND_MSG, ["bob", f"hey {i}"])
+    assert reader.read_frame() == (Protocol.REQ_LIST_USERS, None)
+    assert not reader.has_frame()
+
+def test_frame_split_across_reads(sock_pair):
+    left, right = sock_pair
+    payload = Protocol.encode_obj("split")
+    data = (Protocol.REQ_LOGIN_1).to_bytes(8, "big") + len(payload).to_bytes(4, "big") + payload
+
+    reader = FrameReader(right)
+    # header arrives in two pieces, the rest later
+    def trickle():
+        for chunk in [data[:5], data[5:14], data[14:]]:
+            left.sendall(chunk)
+    t = threading.Thread(target=trickle)
+    t.start()
+    assert reader.read_frame() == (Protocol.REQ_LOGIN_1, "split")
+    t.join()
+
+def test_frame_larger_than_buffer(sock_pair):
+    left, right = sock_pair
+    big = "x" * 100000
+    t = threading.Thread(target=send_data, args=(left, Protocol.REQ_SEND_MSG, ["bob", big]))
+    t.start()
+    reader = FrameReader(right, bufsize=1024)
+    assert reader.read_frame() == (Protocol.REQ_SEND_MSG, ["bob", big])
+    t.join()
+    # the buffer shrinks back once the big frame is consumed
+    assert len(reader.buf) == 1024
+
+def test_closed_mid_header(sock_pair):
+    left, right = sock_pair
+    left.sendall(b"\x00\x00\x00")
+    left.close()
+    assert FrameReader(right).read_frame() == (None, None)
+
+def test_recv_data_short_reads(sock_pair):
+    left, right = sock_pair
+    payload = Protocol.encode_obj(["a", "b"])
+    data = (Protocol.RESP_LIST_USERS).to_bytes(8, "big") + len(payload).to_bytes(4, "big") + payload
+    left.sendall(data[:7])
+    t = threading.Timer(0.1, left.sendall, args=(data[7:],))
+    t.start()
+    assert recv_data(right) == (Protocol.RESP_LIST_USERS, ["a", "b"])
+    t.join()
+
+def test_frame_size_limit(sock_pair):
+    left, right = sock_pair
+    send_data(left, Protocol.REQ_SEND_MSG, ["bob", "x" * 1000])
+    with pytest.raises(ProtocolError):
+        FrameReader(right, max_frame_size=100).read_frame()